@@ -1,6 +1,23 @@
+import os
+import warnings
+from itertools import combinations, combinations_with_replacement
+from multiprocessing import Pool
+
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import PolynomialFeatures  # TODO: implement what I need from this package
+from scipy.linalg import LinAlgError, cho_factor, cho_solve
+from scipy.stats import qmc
+
+# Design being fitted by a worker process, set once per process by _init_worker so tasks only carry their start
+_WORKER = {}
+
+
+def _init_worker(design, powers, levels):
+    _WORKER.update(design=design, powers=powers, levels=levels)
+
+
+def _run_epoch(epoch, design_matrix):
+    return _WORKER['design'].run_epoch(epoch, design_matrix, _WORKER['powers'], _WORKER['levels'])
 
 
 class Design:
@@ -24,6 +41,8 @@ class Design:
         self.bias = None
         self.epochs = None
         self.engine = None
+        self.n_jobs = 1
+        self.dtype = np.float64
 
     # ---------------DUNDER, GETTERS AND SETTERS FUNCTION---------------------------------------------------------------
     def __repr__(self):
@@ -41,15 +60,19 @@ class Design:
         self.interactions_only = interactions_only
         self.bias = bias
 
-    def set_algorithm(self, epochs, engine):
+    def set_algorithm(self, epochs, engine, n_jobs=1, dtype=np.float64):
         """
         :param int epochs: Number of random start to check
         :param str engine: What engine to use for maximization. Includes ("A", "C", "D", "E", "S", "T", "G", "I", "V")
+        :param int n_jobs: Number of processes the random starts are spread over (None for all cpus)
+        :param type dtype: Float type of the exchange algebra (np.float32 halves memory traffic, criteria stay float64)
 
         Setter for algorithm parameters
         """
         self.epochs = epochs
         self.engine = engine
+        self.n_jobs = n_jobs
+        self.dtype = dtype
 
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -57,23 +80,84 @@ class Design:
         """
         Generate a random starting design matrix.
         """
-        df = pd.DataFrame(np.random.random((self.experiments, self.features)))
-        df.columns = ['x' + str(x) for x in list(range(self.features))]
+        df = pd.DataFrame(np.random.random((self.experiments, self.features)), copy=False)
+        df.columns = self.gen_columns()
         return df
 
+    def gen_random_starts(self) -> np.ndarray:
+        """
+        Generate the random starting design matrices of every epoch at once, shape (epochs, experiments, features).
+        A scrambled Sobol sequence spreads them over the design space more evenly than independent uniform draws; it
+        falls back to uniform draws when experiments * features exceeds the dimensions Sobol supports.
+        Epochs that are not a power of two take the leading points of the sequence, which stay well spread, so SciPy's
+        warning about the balance properties of Sobol points is silenced.
+        """
+        dimension = self.experiments * self.features
+        if dimension > qmc.Sobol.MAXDIM:
+            starts = np.random.random((self.epochs, dimension))
+        else:
+            sobol = qmc.Sobol(d=dimension, scramble=True, seed=np.random.randint(2 ** 31 - 1))
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='The balance properties of Sobol', category=UserWarning)
+                starts = sobol.random(self.epochs)
+        return starts.reshape((self.epochs, self.experiments, self.features))
+
+    def gen_columns(self):
+        """
+        Generate the names of the design matrix columns.
+        """
+        return ['x' + str(x) for x in list(range(self.features))]
+
+    def gen_powers(self) -> np.ndarray:
+        """
+        Generate the exponents of every term of the polynomial model, one row per term and one column per feature.
+        Terms are ordered by degree (bias first), the same way sklearn's PolynomialFeatures orders them.
+        """
+        if any(var is None for var in [self.order, self.interactions_only, self.bias]):
+            raise ValueError('Parameters: \'order\', \'interactions_only\' and \'bias\' cannot be None')
+
+        combs = combinations if self.interactions_only else combinations_with_replacement
+        powers = [np.bincount(comb, minlength=self.features)
+                  for degree in range(0 if self.bias else 1, self.order + 1)
+                  for comb in combs(range(self.features), degree)]
+        return np.array(powers, dtype=int).reshape(-1, self.features)
+
+    @staticmethod
+    def gen_feature_names(columns, powers):
+        """
+        :param list columns: Names of the features of the design matrix
+        :param np.ndarray powers: Exponents of every term of the model (see gen_powers)
+
+        Generate the names of the model matrix columns ('1', 'x0', 'x0^2', 'x0 x1', ...)
+        """
+        names = []
+        for row in powers:
+            terms = [name if exp == 1 else f"{name}^{exp}" for name, exp in zip(columns, row) if exp]
+            names.append(' '.join(terms) if terms else '1')
+        return names
+
+    @staticmethod
+    def polynomial(data, powers) -> np.ndarray:
+        """
+        :param np.ndarray data: Design points, shape (..., features)
+        :param np.ndarray powers: Exponents of every term of the model (see gen_powers)
+
+        Evaluate every polynomial term on every design point in one broadcasted np.power, shape (..., terms).
+        Floating point designs keep their precision, anything else is evaluated in float64.
+        """
+        data = np.asarray(data)
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(float)
+        return np.prod(np.power(data[..., np.newaxis, :], powers, dtype=data.dtype), axis=-1)
+
     def gen_model_matrix(self, data=None) -> pd.DataFrame:
         """
         :param pd.DataFrame data: Design matrix
         Generate the model matrix of a design matrix (argument)
         """
-        if any(var is None for var in [self.order, self.interactions_only, self.bias]):
-            raise Exception('Parameters: \'order\', \'interactions_only\' and \'bias\' cannot be None')
-
-        poly = PolynomialFeatures(degree=self.order,
-                                  interaction_only=self.interactions_only,
-                                  include_bias=self.bias)
-        df = pd.DataFrame(poly.fit_transform(data))
-        df.columns = poly.get_feature_names(data.columns)
+        powers = self.gen_powers()
+        df = pd.DataFrame(self.polynomial(data, powers), copy=False)
+        df.columns = self.gen_feature_names(data.columns, powers)
         return df
 
     @staticmethod
@@ -86,7 +170,7 @@ class Design:
        Run the coordinate exchange algorithm and produce the best model matrix, according to the engine chosen, as well as a history of all other possible model matrices and the history of the selected engine used.
        """
 
-        hstry_designs = pd.DataFrame(designs, columns=['epoch', *list(design_mat.columns)])
+        hstry_designs = pd.DataFrame(designs, columns=['epoch', *list(design_mat.columns)], copy=False)
         hstry_opt_cr = pd.DataFrame(optimalities).rename(columns={0: 'epoch',
                                                                   1: 'experiment',
                                                                   2: 'feature'})
@@ -121,68 +205,182 @@ class Design:
         # Priority: Estimation
         # Maximize the determinant of the information matrix X'X of the design.
         # This engine results in maximizing the differential Shannon information content of the parameter estimates.
-        return np.linalg.det(matrix.T @ matrix)
+        # A stack of model matrices (..., experiments, terms) is scored in one batched matmul.
+        matrix = np.asarray(matrix)
+        return np.linalg.det(np.swapaxes(matrix, -1, -2) @ matrix)
 
     @staticmethod
     def a_opt(matrix):
         # Priority: Estimation
         # Maximizes the trace of the information matrix.
         # This engine results in minimizing the average variance of the estimates of the regression coefficients.
-        return np.trace(matrix.T @ matrix)
+        # trace(X'X) is the sum of squares of X, so the product itself is never formed.
+        matrix = np.asarray(matrix)
+        return np.einsum('...ij,...ij->...', matrix, matrix)
 
     @staticmethod
     def e_opt(matrix):
         # Priority: Estimation
         # Maximizes the minimum eigenvalue of the information matrix.
-        w, v = np.linalg.eig(matrix.T @ matrix)
-        w.sort()
-        return w[0]
+        # X'X is symmetric, so its eigenvalues come from the symmetric solver.
+        # A stack of model matrices (..., experiments, terms) is scored in one batched call; one matrix gives a scalar.
+        matrix = np.asarray(matrix)
+        information = np.swapaxes(matrix, -1, -2) @ matrix
+        return np.linalg.eigvalsh(information).min(axis=-1)
+
+    # Rank-one updates -----------------------------------------------------------------------------------------------
+    @staticmethod
+    def factorize(information):
+        """
+        :param np.ndarray information: Information matrix X'X of the design
+
+        Invert the information matrix and compute its determinant from one Cholesky factorization.
+        The inverse is None when the matrix is singular, in which case the exchange updates cannot be used.
+        A float32 matrix too ill-conditioned for its precision is factorized again in float64.
+        """
+        eps = np.finfo(information.dtype).eps
+        try:
+            factor = cho_factor(information, lower=True)
+            diagonal = np.abs(np.diag(factor[0]))
+            singular = diagonal.min() ** 2 < eps * diagonal.max() ** 2
+        except LinAlgError:
+            singular = True
+        if singular and information.dtype != np.float64:
+            return Design.factorize(information.astype(np.float64))
+        if singular:
+            return None, np.linalg.det(information)
+        inverse = cho_solve(factor, np.identity(len(information), dtype=information.dtype))
+        # the determinant is accumulated in float64 so that it does not overflow a float32 design
+        return inverse, np.prod(diagonal, dtype=np.float64) ** 2
+
+    @staticmethod
+    def exchange_ratio(inverse, old_row, new_row):
+        """
+        :param np.ndarray inverse: Inverse of the information matrix M
+        :param np.ndarray old_row: Model matrix row leaving the design
+        :param np.ndarray new_row: Model matrix row(s) entering the design, shape (..., p)
+
+        Ratio det(M - old_row old_row' + new_row new_row') / det(M), by the matrix determinant lemma, in O(p^2).
+        Several candidate rows are scored at once when new_row is a stack.
+        """
+        inv_new = new_row @ inverse
+        return ((1 + np.einsum('...i,...i->...', new_row, inv_new)) * (1 - old_row @ inverse @ old_row)
+                + (inv_new @ old_row) ** 2)
+
+    @staticmethod
+    def exchange_inverse(inverse, old_row, new_row):
+        """
+        :param np.ndarray inverse: Inverse of the information matrix M
+        :param np.ndarray old_row: Model matrix row leaving the design
+        :param np.ndarray new_row: Model matrix row entering the design
+
+        Inverse of M - old_row old_row' + new_row new_row', by two Sherman-Morrison updates, in O(p^2).
+        """
+        u = inverse @ new_row
+        inverse = inverse - np.outer(u, u) / (1 + new_row @ u)
+        v = inverse @ old_row
+        return inverse + np.outer(v, v) / (1 - old_row @ v)
+
+    def run_epoch(self, epoch, design_matrix, powers, levels):
+        """
+        :param int epoch: Index of the random start
+        :param np.ndarray design_matrix: Random starting design matrix, updated in place
+        :param np.ndarray powers: Exponents of every term of the model (see gen_powers)
+        :param list levels: Levels of every feature as arrays in the dtype of the exchange algebra
+
+        Run the coordinate exchange algorithm from one random start and return the final design matrix, the history of
+        the engine for every (experiment, feature) coordinate and the best engine value of that history.
+        """
+        hstry_opt_cr = []
+        best_opt_cr = -np.inf
+        # per feature: a reusable buffer of candidate design points
+        points = [np.empty((len(feat_levels), self.features), dtype=feat_levels.dtype) for feat_levels in levels]
+
+        # the algebra runs in self.dtype, the design matrix keeps the levels exactly as given
+        model_matrix = self.polynomial(design_matrix.astype(self.dtype), powers)
+        for exp in range(self.experiments):
+            # refactor once per experiment so the rank-one updates do not drift
+            inverse, det = self.factorize(model_matrix.T @ model_matrix)
+            for feat in range(self.features):
+                old_row = model_matrix[exp].copy()
+                # check all possible levels for the specific experiment, feature in one batch
+                points[feat][:] = design_matrix[exp]
+                points[feat][:, feat] = levels[feat]
+                coordinate_rows = self.polynomial(points[feat], powers)
+
+                if inverse is None:
+                    candidates = np.repeat(model_matrix[np.newaxis], len(coordinate_rows), axis=0)
+                    candidates[:, exp] = coordinate_rows
+                    # in float64, like the determinant of the exchange updates, so a float32 design does not overflow
+                    coordinate_opt_cr = self.d_opt(candidates.astype(np.float64))
+                else:
+                    coordinate_opt_cr = det * self.exchange_ratio(inverse, old_row, coordinate_rows)
+
+                hstry_opt_cr.append([epoch, exp, feat, *coordinate_opt_cr])
+                # updated design_matrix
+                best = int(np.argmax(coordinate_opt_cr))
+                best_opt_cr = max(best_opt_cr, coordinate_opt_cr[best])
+                design_matrix[exp, feat] = self.levels[feat][best]
+                model_matrix[exp] = coordinate_rows[best]
+                if inverse is not None and coordinate_opt_cr[best] > 0:
+                    inverse = self.exchange_inverse(inverse, old_row, coordinate_rows[best])
+                    det = coordinate_opt_cr[best]
+                else:
+                    inverse = None
+
+        return design_matrix, hstry_opt_cr, best_opt_cr
 
     def fit(self):
         self.guards()
 
         hstry_opt_cr = []  # all optimality criteria in a dataframe
-        hstry_designs = np.array([]).reshape((0, self.features + 1))  # all final designs in a dataframe
-
-        for epoch in range(self.epochs):
-            design_matrix = self.gen_random_design()
-            for exp in range(self.experiments):
-                for feat in range(self.features):
-                    coordinate_opt_cr = []
-                    for count, level in enumerate(self.levels[feat]):
-                        # check all possible levels for the specific experiment, feature
-                        design_matrix.iat[exp, feat] = level
-                        model_matrix = self.gen_model_matrix(data=design_matrix)
-
-                        engine = self.d_opt(model_matrix)
-                        coordinate_opt_cr.append(engine)
-
-                    hstry_opt_cr.append([epoch, exp, feat, *coordinate_opt_cr])
-                    # updated design_matrix
-                    design_matrix.iat[exp, feat] = self.levels[feat][coordinate_opt_cr.index(max(coordinate_opt_cr))]
-
-            # clean results of inner loops
-            hstry_designs = np.append(hstry_designs,
-                                      np.hstack((np.array([epoch] * self.experiments).reshape(-1, 1),
-                                                 np.array(design_matrix))),
-                                      axis=0)
+        hstry_designs = np.empty((self.epochs * self.experiments, self.features + 1))  # all final designs
+
+        # random starts are all drawn here in one call, so that worker processes do not share a copied random state
+        starts = self.gen_random_starts()
+
+        # loop invariants, computed once per fit rather than once per epoch
+        powers = self.gen_powers()
+        levels = [np.asarray(self.levels[feat], dtype=self.dtype) for feat in range(self.features)]
+
+        if self.n_jobs == 1:
+            results = [self.run_epoch(epoch, start, powers, levels) for epoch, start in enumerate(starts)]
+        else:
+            # a few chunks per process amortize the pickling of tasks without starving the pool at the end
+            processes = self.n_jobs or os.cpu_count()
+            with Pool(processes=processes, initializer=_init_worker, initargs=(self, powers, levels)) as pool:
+                results = pool.starmap(_run_epoch, zip(range(self.epochs), starts),
+                                       chunksize=max(1, self.epochs // (processes * 4)))
+
+        # clean results of inner loops into the preallocated history, one block of rows per epoch
+        hstry_designs[:, 0] = np.repeat(np.arange(self.epochs), self.experiments)
+        best_epoch, best_opt_cr = 0, -np.inf
+        for epoch, (design_matrix, epoch_opt_cr, epoch_best) in enumerate(results):
+            hstry_opt_cr.extend(epoch_opt_cr)
+            hstry_designs[epoch * self.experiments:(epoch + 1) * self.experiments, 1:] = design_matrix
+            # running best, same pick as find_best_design without regrouping the whole history
+            if epoch_best > best_opt_cr:
+                best_epoch, best_opt_cr = epoch, epoch_best
 
         hstry_designs, hstry_opt_cr = self.clear_histories(optimalities=hstry_opt_cr, designs=hstry_designs,
-                                                           design_mat=design_matrix)
-        best_design = self.find_best_design(histories=hstry_opt_cr, designs=hstry_designs)
+                                                           design_mat=pd.DataFrame(columns=self.gen_columns()))
+        best_design = pd.DataFrame(results[best_epoch][0], columns=self.gen_columns(), copy=False)
         model_matrix = self.gen_model_matrix(data=best_design)
 
         return best_design, model_matrix, hstry_designs, hstry_opt_cr
 
 
 class Optimal(Design):
-    def __init__(self, experiments, levels, order, interactions_only, bias, epochs, engine):
+    def __init__(self, experiments, levels, order, interactions_only, bias, epochs, engine, n_jobs=1,
+                 dtype=np.float64):
         super().__init__(experiments, levels)
         self.order = order
         self.interactions_only = interactions_only
         self.bias = bias
         self.epochs = epochs
         self.engine = engine
+        self.n_jobs = n_jobs
+        self.dtype = dtype
 
     def test(self):
         print(self.experiments)